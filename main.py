@@ -5,6 +5,27 @@ Author: Sagar Sen
 Date created: 19-10-2023
 Revision history:
 23-10-2023 Updated prompt to be more precise about only including security debts if they exist in the response
+15-10-2026 Batched the modified files of a commit into a single LLM call
+15-10-2026 Analyze the batches of a commit concurrently with the async OpenAI API
+15-10-2026 Cache the analyses of the AI engine on disk
+15-10-2026 Only send the changed lines of modified files, with some context, to the AI engine
+15-10-2026 Walk the commits with pygit2, keeping pydriller as a fallback
+15-10-2026 Let the AI engine size its responses instead of reserving max_tokens
+15-10-2026 Filter modified files on their path before loading their source code
+15-10-2026 Append the debts to a JSON Lines file instead of rewriting a JSON file after each commit
+15-10-2026 Build the guard once at import time
+15-10-2026 Migrated the debts schema to pydantic v2, with Literal debt types
+15-10-2026 Moved the instructions and schema to a fixed system message so the AI engine can cache them
+15-10-2026 Skip merge commits, vendored code and trivial changes
+15-10-2026 Count tokens with tiktoken and split files too long for the context of the AI engine
+15-10-2026 Analyze identical code only once across commits and files
+15-10-2026 Back off exponentially when retrying the AI engine, and log the retries
+15-10-2026 Only generate the patches of the modified files that are analyzed
+15-10-2026 Walk the commits in a separate process, overlapping with the analysis of the commits already walked
+15-10-2026 Ask for deterministic JSON responses and shortened the output instructions
+15-10-2026 Replaced guardrails with the strict structured outputs of the AI engine, so invalid debt types are never reasked
+15-10-2026 Clone the repositories once into .cache and fetch the new commits on later runs
+15-10-2026 Only keep the hashes of the analyzed commits in memory when resuming
 Purpose: Analyzing security debt in commits within GitHub repositories to identify potential vulnerabilities and technical debt leading to security issues.
 Copyright: (c) 2023 Sagar Sen. All rights reserved.
 Notes: This program analyzes commits in GitHub repositories to identify patterns that might indicate security debt. The analysis includes checking for hard-coded credentials, use of outdated libraries, and other common security debt indicators.
@@ -14,84 +35,154 @@ Contact: sagar.sen@sintef.no
 """
 Pre-requisities
 !pip install pydriller
+!pip install pygit2
 !pip install requests
-!pip install openai==0.28.1
+!pip install "openai>=1.40"
 !pip install pygments
-!pip install pydantic==1.10.9
+!pip install "pydantic>=2.5"
 !apt-get install -y graphviz openjdk-11-jre-headless
-!pip install guardrails-ai  typing  rich
+!pip install typing  rich
 !pip install tiktoken
+!pip install diskcache
 """
 
+import asyncio
+import bisect
+import collections
+import functools
+import hashlib
 import textwrap
 from pygments.lexers import get_lexer_by_name
+from pygments.token import Token
 from pygments.util import ClassNotFound
 import os
 import openai
-from pydriller import Repository
-import time
+import pygit2
+from pydriller import ModificationType, Repository
 import re
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from guardrails.validators import ValidRange, ValidChoices
+import subprocess
+from queue import Empty
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Literal, Optional
 from rich import print
-import guardrails as gd
+import tiktoken
 import argparse
+import diskcache
 import json
+import logging
+import multiprocessing
 import os
 
 #Setup openai
 engineName="jaipetefort"
-openai.api_type = "azure"
-openai.api_base = "https://03.openai.azure.com/"
-openai.api_version = "2023-07-01-preview"
+# Model served by the deployment, which sets the tokenizer and the context window
+modelName="gpt-4o"
+azure_endpoint = "https://03.openai.azure.com/"
+api_version = "2024-08-01-preview"
 # Read API key from environment variable
-openai.api_key = os.getenv('OPENAI_API_KEY')
+api_key = os.getenv('OPENAI_API_KEY')
 
-if not openai.api_key:
+if not api_key:
     raise ValueError("No API key found. Please set the OPENAI_API_KEY environment variable.")
 
+# The responses are parsed into the debts schema with the structured outputs of the AI engine. The schema is sent as a
+# strict JSON schema, so it is enforced, including the choices of debt types, while the response is generated, and
+# invalid responses are not reasked. Failed calls are retried by call_openai_api rather than by the client.
+_CLIENT = openai.AsyncAzureOpenAI(api_key=api_key, azure_endpoint=azure_endpoint, api_version=api_version, max_retries=0)
+
+# Context window of the models supporting strict structured outputs
+_MODEL_CONTEXT_TOKENS = {'gpt-4o': 128000, 'gpt-4o-mini': 128000}
+MODEL_CONTEXT_TOKENS = _MODEL_CONTEXT_TOKENS[modelName]
+# Part of the context window kept for the response of the AI engine
+MAX_OUTPUT_TOKENS = 4096
+# Upper bound on the combined number of tokens of the code snippets analyzed in a single LLM call
+MAX_BATCH_TOKENS = 3000
+# Tokenizer of the AI engine, to count tokens before sending a request rather than have it rejected by the API
+_ENC = tiktoken.encoding_for_model(modelName)
+# A basic set of source code extensions; can be expanded based on requirements
+SOURCE_CODE_EXTENSIONS = frozenset([
+    '.c', '.cpp', '.h', '.java', '.py', '.js', '.php',
+    '.cs', '.rb', '.go', '.rs', '.ts', '.m', '.swift',
+    '.f', '.f90', '.perl', '.sh', '.bash'
+])
+# Local clones of the analyzed repositories, kept across runs
+REPOSITORY_CACHE_DIR = '.cache'
+# Upper bound on the number of walked commits waiting to be analyzed, and on the number of commits analyzed concurrently
+COMMIT_QUEUE_SIZE = 16
+# Seconds to wait for a walked commit before checking that the producer process is still alive
+QUEUE_POLL_SECONDS = 1
+MAX_PENDING_COMMITS = 8
+# Vendored, generated and build directories, whose files are not worth analyzing
+_SKIP_RE = re.compile(r'(^|/)(node_modules|vendor|\.git|dist|build|__pycache__|\.venv|site-packages|third_party)/')
+# Files with fewer added and deleted lines than this are unlikely to introduce debts and are not analyzed
+MIN_CHANGED_LINES = 3
+# Number of unchanged lines kept around each changed line of a modified file
+DIFF_CONTEXT_LINES = 10
+# Upper bound on the number of concurrent requests to the AI engine, to respect the Azure rate limits
+MAX_CONCURRENT_REQUESTS = 8
+_llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# Persistent cache of the analyses returned by the AI engine, so that identical code is only analyzed once across runs
+LLM_CACHE_DIR = './llm_cache'
+_llm_cache = diskcache.Cache(LLM_CACHE_DIR)
+# In-memory table of the analyses of the most recently seen code, keyed by a hash of the code, in front of the LLM response cache
+BLOB_CACHE_SIZE = 4096
+_blob_cache = collections.OrderedDict()
+
 
 
 
 
 #Helper Functions
 
-def call_openai_api(messages, retries=3):
-    for _ in range(retries):
+# Extracts the delay asked for by the AI engine from the message of its rate limit errors
+_RETRY_RE = re.compile(r'(\d+)\s+seconds?')
+
+async def call_openai_api(response_model, messages, retries=5):
+    """
+    Call the AI engine, retrying when it is rate limited or temporarily unavailable.
+
+    The semaphore bounding the concurrent requests is released while waiting to retry.
+
+    Args:
+    - response_model (type): The pydantic model the response is parsed into.
+    - messages (list): The messages of the chat completion.
+    - retries (int): The number of attempts before giving up.
+
+    Returns:
+    - BaseModel: The parsed response.
+    """
+    for attempt in range(retries):
         try:
-            response = openai.ChatCompletion.create(
-                engine=engineName,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500,
-                top_p=0.95,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-            return response
-        except openai.error.InvalidRequestError as e:
+            async with _llm_semaphore:
+                completion = await _CLIENT.beta.chat.completions.parse(
+                    model=engineName,
+                    response_format=response_model,
+                    messages=messages,
+                    temperature=0.0,
+                )
+            message = completion.choices[0].message
+            if message.parsed is None:
+                raise ValueError("The AI engine refused to analyze the code: " + str(message.refusal))
+            return message.parsed
+        except openai.BadRequestError as e:
             # Specifically handle the token limit error
-            if "Maximum context length" in str(e) and "tokens" in str(e):
-                print("Error: Message length exceeds the model's token limit. Please reduce the length of the messages.")
-                # You might want to break here, as reducing the message length requires user intervention.
-                break
-        except Exception as e:
-            error=(f"Error: {e}.")
-            print(wrap_text(error))
-            #print(f"Error: {e}.")
-            match = re.search(r'(\d+)\s+seconds?', str(e))
-            if match:
-              seconds = int(match.group(1))
-              print(seconds)
+            if e.code == "context_length_exceeded":
+                logging.error("Message length exceeds the model's token limit. Please reduce the length of the messages.")
+            # Retrying the same request would fail again
+            raise
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            if attempt == retries - 1:
+                raise
+            # Wait as long as the AI engine asks for, in the Retry-After header or in the message, or back off exponentially
+            # if it does not say
+            retry_after = e.response.headers.get('retry-after', '') if isinstance(e, openai.APIStatusError) else ''
+            match = _RETRY_RE.search(str(e))
+            if retry_after.isdigit():
+                seconds = int(retry_after)
             else:
-              print("Seconds not found in the text!")
-            print("Retrying calling AI engine in "+str(seconds)+" seconds...")
-            time.sleep(seconds)
-        else:
-            raise Exception("Failed to call OpenAI API after multiple retries.")
-        
+                seconds = int(match.group(1)) if match else 2 ** attempt
+            logging.warning("Error calling AI engine: %s. Retrying in %d seconds...", e, seconds)
+            await asyncio.sleep(seconds)
 
 
 """
@@ -100,56 +191,42 @@ Technical and Security Debts Schema
 
 
 class TechnicalDebt(BaseModel):
-    type: str = Field(
-    description="What type of technical debt is identified in this code snippet?",
-    validators=[
-        ValidChoices(
-            choices=[
-                'Code Duplication',
-                'Complex Code',
-                'Long Methods',
-                'Poorly Named Classes/Methods',
-                'Lack of Modularity',
-                'Insufficient Testing',
-                'Outdated Documentation',
-                'Lack of Coding Standards',
-                'Hard-coded Values',
-                'Deprecated Dependencies',
-                'Ignoring Refactoring',
-                'Error/Exception Handling',
-                'Inefficient Resource Management',
-                'Lack of Concurrency Control'
-            ],
-            on_fail="reask"
-        )
-    ])
+    type: Literal[
+        'Code Duplication',
+        'Complex Code',
+        'Long Methods',
+        'Poorly Named Classes/Methods',
+        'Lack of Modularity',
+        'Insufficient Testing',
+        'Outdated Documentation',
+        'Lack of Coding Standards',
+        'Hard-coded Values',
+        'Deprecated Dependencies',
+        'Ignoring Refactoring',
+        'Error/Exception Handling',
+        'Inefficient Resource Management',
+        'Lack of Concurrency Control'
+    ] = Field(description="What type of technical debt is identified in this code snippet?")
     symptom: str = Field(description="Technical debt in the code snippet.")
     affected_area: str= Field(description="What are the lines of code with the technical debt?")
     suggested_repair: str= Field(description="Generate code to refactor or repair the technical debt")
 
 
 class SecurityDebt(BaseModel):
-    type: str = Field(
-    description="What is the security debt in this code snippet?",
-    validators=[
-        ValidChoices(
-            choices=[
-                'Hardcoded Secrets',
-                'Insecure Dependencies',
-                'Lack of Input Validation',
-                'Insufficient Error Handling',
-                'Inadequate Encryption',
-                'Improper Session Management',
-                'Insecure Default Settings',
-                'Lack of Principle of Least Privilege',
-                'Insecure Direct Object References',
-                'Cross-Site Request Forgery (CSRF)',
-                'Ignoring Security Warnings',
-                'Not Adhering to Secure Coding Standards'
-            ],
-            on_fail="reask"
-        )
-    ])
+    type: Literal[
+        'Hardcoded Secrets',
+        'Insecure Dependencies',
+        'Lack of Input Validation',
+        'Insufficient Error Handling',
+        'Inadequate Encryption',
+        'Improper Session Management',
+        'Insecure Default Settings',
+        'Lack of Principle of Least Privilege',
+        'Insecure Direct Object References',
+        'Cross-Site Request Forgery (CSRF)',
+        'Ignoring Security Warnings',
+        'Not Adhering to Secure Coding Standards'
+    ] = Field(description="What is the security debt in this code snippet?")
     symptom: str = Field(description="Security debt in the code snippet.")
     affected_area: str= Field(description="What are the lines of code with the security debt?")
     suggested_repair: str= Field(description="Generate code to refactor or repair the security debt")
@@ -174,42 +251,440 @@ class CodeInfo(BaseModel):
     securityDebts: List[SecurityDebt] = Field(description="Are there security debts in the code snippet? Each security debt should be classified into  separate item in the list.")
     technicalDebts: List[TechnicalDebt] = Field(description="Are there technical debts in the code snippet? Each technical debt should be classified into  separate item in the list.")
 
-def createGuard(code_changes):
+class BatchCodeInfo(BaseModel):
+    """
+    A model wrapping the CodeInfo results of several code snippets analyzed in a single LLM call.
+
+    Attributes:
+    - results (List[CodeInfo]): One CodeInfo per code snippet, in the same order as the snippets were given.
+    """
+    results: List[CodeInfo] = Field(description="The analysis of each code snippet in the list, in the same order as the snippets were given. There must be exactly one item per code snippet.")
+
+# The instructions are sent as the system message and never change between calls, so that the AI engine can serve this
+# prefix of the prompt from its prompt cache. Only the user message, holding the code, changes from one call to the next.
+DEBT_INSTRUCTIONS = """
+  You will be given a JSON array of code snippets, where each item has the "path" of the file and its "code". Please extract for each snippet a dictionary that contains the security vulnerabilities in the code. Validate if these vulnerabilities actually exist. Return exactly one result per snippet, in the same order as the snippets. When a file was only partly changed, its code is an excerpt of the changed lines and their surroundings, each line prefixed with its line number, and "..." separating the parts of the file that were left out.
+  """
+
+# The schema is sent to the AI engine as the response format, it is part of the prompt like the instructions
+_DEBT_SCHEMA = json.dumps(BatchCodeInfo.model_json_schema(), sort_keys=True)
 
-  prompt = """
-  Given the following code snippet, please extract a dictionary that contains the security vulnerabilities in the code. Validate if these vulnerabilities actually exist.
+# Code snippets longer than this are split into chunks before being sent to the AI engine. The rest of the context window
+# holds the instructions, the schema and the response.
+MAX_SNIPPET_TOKENS = MODEL_CONTEXT_TOKENS - len(_ENC.encode(DEBT_INSTRUCTIONS + _DEBT_SCHEMA, disallowed_special=())) - MAX_OUTPUT_TOKENS
 
-  ${code_changes} <!-- (2)! -->
+# Validates the analyses read back from the LLM response cache
+_CODE_INFO_ADAPTER = TypeAdapter(CodeInfo)
 
-  ${gr.complete_json_suffix_v2} <!-- (3)! -->
+def llm_cache_key(code_changes):
   """
+  Compute the key of a code snippet in the persistent LLM response cache.
 
-  # From pydantic:
-  guard = gd.Guard.from_pydantic(output_class=CodeInfo, prompt=prompt)
+  The key covers the engine, the instructions and the schema as well as the code, so that changing any of them invalidates the cached analyses.
 
-  #print(guard)
+  Args:
+  - code_changes (str): The code snippet to analyze.
 
-  return guard
+  Returns:
+  - str: The SHA256 hex digest identifying the analysis of the code snippet.
+  """
+  return hashlib.sha256((engineName + DEBT_INSTRUCTIONS + _DEBT_SCHEMA + code_changes).encode('utf-8')).hexdigest()
+
+async def queryDebts(code_changes_list):
+  """
+  Ask the AI engine to analyze several code snippets for technical and security debts with a single LLM call.
 
-def debtDetect(code_changes,guard):
+  Args:
+  - code_changes_list (list): (path, code) tuples to analyze together.
 
-  # Wrap the OpenAI API call with the `guard` object
-  raw_llm_output, validated_output = guard(
-    openai.ChatCompletion.create,
-    prompt_params={"code_changes": code_changes},
-    engine="jaipetefort",
-    max_tokens=1024,
-    temperature=0.3,
+  Returns:
+  - list: One CodeInfo dictionary per snippet, in the same order as code_changes_list.
+  """
+  snippets = [{"path": path, "code": code} for path, code in code_changes_list]
+
+  # The response is parsed and validated into the schema
+  batch_code_info = await call_openai_api(
+    BatchCodeInfo,
+    [
+      {"role": "system", "content": DEBT_INSTRUCTIONS},
+      {"role": "user", "content": json.dumps(snippets, indent=2, ensure_ascii=False)},
+    ],
     )
-  #print(validated_output)
-  return validated_output
+  #print(batch_code_info)
+  results = [code_info.model_dump() for code_info in batch_code_info.results]
+  if len(results) != len(code_changes_list):
+    if len(code_changes_list) == 1:
+      raise ValueError("The AI engine did not return a valid analysis for " + code_changes_list[0][0])
+    # The model lost track of the snippets, fall back to analyzing them one by one
+    results = await asyncio.gather(*[queryDebts([code_change]) for code_change in code_changes_list])
+    return [result[0] for result in results]
+  return results
+
+async def debtDetectBatch(code_changes_list):
+  """
+  Analyze several code snippets for technical and security debts.
+
+  Snippets analyzed in a previous run are answered from the persistent LLM response cache, the others are sent to the AI engine in a single LLM call.
+
+  Args:
+  - code_changes_list (list): (path, code) tuples to analyze together.
+
+  Returns:
+  - list: One CodeInfo dictionary per snippet, in the same order as code_changes_list.
+  """
+  keys = [llm_cache_key(code) for _, code in code_changes_list]
+  results = []
+  for key in keys:
+    cached = _llm_cache.get(key)
+    try:
+      results.append(_CODE_INFO_ADAPTER.validate_json(cached).model_dump() if cached is not None else None)
+    except ValidationError:
+      # Cached with an older schema, analyze the snippet again
+      results.append(None)
+
+  missing = [i for i, result in enumerate(results) if result is None]
+  if missing:
+    analyzed = await queryDebts([code_changes_list[i] for i in missing])
+    for i, debt in zip(missing, analyzed):
+      _llm_cache[keys[i]] = json.dumps(debt)
+      results[i] = debt
+  return results
+
+
+def count_tokens(text):
+    """
+    Count the tokens of a text for the AI engine.
+
+    :param text: Text to count the tokens of
+    :return: Number of tokens
+    """
+    return len(_ENC.encode(text, disallowed_special=()))
+
+def count_snippet_tokens(path, code):
+    """
+    Count the tokens of a code snippet as it is sent to the AI engine, with its path and escaped into JSON.
+
+    :param path: Path of the file
+    :param code: Code snippet
+    :return: Number of tokens
+    """
+    return count_tokens(json.dumps([{"path": path, "code": code}], indent=2, ensure_ascii=False))
+
+def count_json_tokens(text):
+    """
+    Count the tokens of a text once escaped into a JSON string, as the code is sent to the AI engine.
+
+    :param text: Text to count the tokens of
+    :return: Number of tokens
+    """
+    return count_tokens(json.dumps(text, ensure_ascii=False))
+
+def split_text(text, max_tokens):
+    """
+    Cut a text in halves, recursively, until each piece fits in max_tokens once escaped into a JSON string.
+
+    :param text: Text to cut
+    :param max_tokens: Upper bound on the number of tokens of a piece
+    :return: The pieces of the text, in order
+    """
+    if len(text) <= 1 or count_json_tokens(text) <= max_tokens:
+        return [text]
+    middle = len(text) // 2
+    return split_text(text[:middle], max_tokens) + split_text(text[middle:], max_tokens)
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(ext):
+    """
+    Get the pygments lexer for a file extension.
+
+    :param ext: File extension, such as '.py'
+    :return: The lexer, or None if pygments does not know the extension
+    """
+    try:
+        return get_lexer_by_name(ext.lstrip('.'))
+    except ClassNotFound:
+        return None
+
+def definition_lines(path, code):
+    """
+    Find the lines where functions and classes are defined in a code snippet.
+
+    Args:
+    - path (str): The path of the file, used to pick the pygments lexer.
+    - code (str): The code snippet.
+
+    Returns:
+    - set: The indexes (starting at 0) of the lines defining a function or a class, empty if the language is not known.
+    """
+    lexer = get_lexer(os.path.splitext(path)[1])
+    if lexer is None:
+        return set()
+
+    line_starts = [0]
+    for line in code.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    return {
+        bisect.bisect_right(line_starts, index) - 1
+        for index, token_type, _ in lexer.get_tokens_unprocessed(code)
+        if token_type in Token.Name.Function or token_type in Token.Name.Class
+    }
+
+def split_code(path, code, max_tokens=MAX_SNIPPET_TOKENS):
+    """
+    Split a code snippet that does not fit in the context of the AI engine into chunks.
+
+    Chunks are cut at function and class definitions when pygments knows the language of the file. Definitions that are
+    too long by themselves are cut between lines, and lines that are too long by themselves are cut in pieces.
+
+    Args:
+    - path (str): The path of the file.
+    - code (str): The code snippet.
+    - max_tokens (int): Upper bound on the number of tokens of a chunk, as it is sent to the AI engine.
+
+    Returns:
+    - list: The chunks of the code snippet, a single one if it already fits.
+    """
+    if count_snippet_tokens(path, code) <= max_tokens:
+        return [code]
+    # Budget of the code itself, escaped into JSON, once the path and the JSON around it are accounted for
+    max_tokens -= count_snippet_tokens(path, '')
+
+    lines = code.splitlines(keepends=True)
+    boundaries = definition_lines(path, code)
+    sections, section = [], []
+    for i, line in enumerate(lines):
+        if i in boundaries and section:
+            sections.append(''.join(section))
+            section = []
+        section.append(line)
+    sections.append(''.join(section))
+
+    units = []
+    for section in sections:
+        if count_json_tokens(section) <= max_tokens:
+            units.append(section)
+            continue
+        for line in section.splitlines(keepends=True):
+            units.extend(split_text(line, max_tokens))
+
+    chunks, chunk, chunk_tokens = [], [], 0
+    for unit in units:
+        tokens = count_json_tokens(unit)
+        if chunk and chunk_tokens + tokens > max_tokens:
+            chunks.append(''.join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(unit)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(''.join(chunk))
+    return chunks
+
+
+def batch_code_changes(code_changes, max_tokens=MAX_BATCH_TOKENS):
+    """
+    Group code snippets into batches so that several of them can be analyzed with a single LLM call.
+
+    Args:
+    - code_changes (list): (path, code) tuples to group.
+    - max_tokens (int): Upper bound on the combined number of tokens of the snippets of a batch, as they are sent to the AI engine. A snippet longer than this is put in a batch of its own.
+
+    Returns:
+    - list: Batches of (path, code) tuples, preserving the order of code_changes.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for path, code in code_changes:
+        tokens = count_snippet_tokens(path, code)
+        if batch and batch_tokens + tokens > max_tokens:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((path, code))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+"""
+Commit Traversal
+"""
+
+
+class Pygit2ModifiedFile:
+    """
+    A file modified by a commit, backed by a pygit2 diff.
+
+    This class exposes the subset of pydriller's ModifiedFile used by main(), so that the rest of the program does not
+    depend on which library walked the commits. The paths come from the diff delta, which is cheap, while the patch of
+    the file is only generated when its lines are accessed.
+
+    Attributes:
+    - change_type (ModificationType): How the file was changed by the commit.
+    - new_path (str): The path of the file after the commit, None if the file was deleted.
+    - old_path (str): The path of the file before the commit, None if the file was added.
+    """
+    _CHANGE_TYPES = {
+        pygit2.GIT_DELTA_ADDED: ModificationType.ADD,
+        pygit2.GIT_DELTA_DELETED: ModificationType.DELETE,
+        pygit2.GIT_DELTA_MODIFIED: ModificationType.MODIFY,
+        pygit2.GIT_DELTA_RENAMED: ModificationType.RENAME,
+        pygit2.GIT_DELTA_COPIED: ModificationType.COPY,
+    }
+
+    def __init__(self, repo, diff, index, delta):
+        self._repo = repo
+        self._diff = diff
+        self._index = index
+        self._patch = None
+        self.change_type = self._CHANGE_TYPES.get(delta.status, ModificationType.UNKNOWN)
+        self.new_path = None if self.change_type == ModificationType.DELETE else delta.new_file.path
+        self.old_path = None if self.change_type == ModificationType.ADD else delta.old_file.path
+
+    def _get_patch(self):
+        if self._patch is None:
+            self._patch = self._diff[self._index]
+        return self._patch
+
+    @property
+    def source_code(self):
+        """The source code of the file after the commit, None if the file was deleted or is binary."""
+        if self.new_path is None:
+            return None
+        delta = self._get_patch().delta
+        if delta.is_binary:
+            return None
+        return self._repo[delta.new_file.id].data.decode('utf-8', 'ignore')
+
+    @property
+    def added_lines(self):
+        """The number of lines added by the commit."""
+        return self._get_patch().line_stats[1]
+
+    @property
+    def deleted_lines(self):
+        """The number of lines deleted by the commit."""
+        return self._get_patch().line_stats[2]
+
+    @property
+    def diff_parsed(self):
+        """The added and deleted lines, as (line number, line) tuples, in the same format as pydriller."""
+        added, deleted = [], []
+        for hunk in self._get_patch().hunks:
+            for line in hunk.lines:
+                if line.origin == '+':
+                    added.append((line.new_lineno, line.content.rstrip('\n')))
+                elif line.origin == '-':
+                    deleted.append((line.old_lineno, line.content.rstrip('\n')))
+        return {'added': added, 'deleted': deleted}
+
+
+class Pygit2Commit:
+    """
+    A commit walked with pygit2.
+
+    The hash is available right away, while the modified files are only computed when they are accessed, so that commits
+    which were already analyzed can be skipped at almost no cost.
+
+    Attributes:
+    - hash (str): The hash of the commit.
+    - parents (List[str]): The hashes of the parents of the commit.
+    """
+    def __init__(self, repo, commit):
+        self._repo = repo
+        self._commit = commit
+        self.hash = str(commit.id)
+        self.parents = [str(parent_id) for parent_id in commit.parent_ids]
+
+    @property
+    def modified_files(self):
+        """
+        The files modified by the commit, compared to its first parent, created lazily as they are iterated.
+
+        For a merge commit, only the files that differ from every parent are kept, such as conflict resolutions, rather
+        than every file of the merged branch.
+        """
+        if self._commit.parents:
+            diff = self._repo.diff(self._commit.parents[0], self._commit)
+        else:
+            # Root commit, every file is added
+            diff = self._commit.tree.diff_to_tree(swap=True)
+        diff.find_similar()
+        merged_paths = None
+        for parent in self._commit.parents[1:]:
+            paths = {delta.new_file.path for delta in self._repo.diff(parent, self._commit).deltas}
+            merged_paths = paths if merged_paths is None else merged_paths & paths
+        return (
+            Pygit2ModifiedFile(self._repo, diff, index, delta) for index, delta in enumerate(diff.deltas)
+            if merged_paths is None or delta.new_file.path in merged_paths
+        )
+
+
+def local_repository(repo_url):
+    """
+    Clone a repository into the repository cache the first time it is analyzed, and only fetch new commits afterwards.
+
+    The clone is a mirror, so that fetching updates its branches, and has no working tree. It is a full clone: libgit2
+    cannot fetch missing blobs, and git would fetch the blobs of a partial clone one commit at a time while pydriller
+    diffs the commits.
+
+    Args:
+    - repo_url (str): The URL of the repository, or the path to a local clone which is used as is.
+
+    Returns:
+    - str: The path of the local clone.
+    """
+    if os.path.isdir(repo_url):
+        return repo_url
+
+    local_path = os.path.join(REPOSITORY_CACHE_DIR, url_to_filename(repo_url))
+    if os.path.isdir(local_path):
+        subprocess.run(['git', '-C', local_path, 'fetch', '--all', '--prune'], check=True)
+    else:
+        subprocess.run(['git', 'clone', '--mirror', repo_url, local_path], check=True)
+    return local_path
+
+
+def traverse_commits(repo_url, backend='pygit2'):
+    """
+    Iterate over the commits of a repository, from the oldest to the newest.
+
+    Args:
+    - repo_url (str): The URL of the repository, or the path to a local clone.
+    - backend (str): 'pygit2' to walk the commits with libgit2, or 'pydriller' to use pydriller.
+
+    Yields:
+    - Pygit2Commit or pydriller Commit: The commits of the repository.
+    """
+    if backend == 'pydriller':
+        yield from Repository(local_repository(repo_url)).traverse_commits()
+        return
+
+    repo = pygit2.Repository(local_repository(repo_url))
+    for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE):
+        yield Pygit2Commit(repo, commit)
+
+
+def changed_paths(commit):
+    """
+    List the paths of the files changed by a pydriller commit, without generating its diff.
+
+    Args:
+    - commit (pydriller Commit): The commit.
+
+    Returns:
+    - list: The paths of the files changed by the commit, compared to its first parent. Empty for a merge commit.
+    """
+    output = subprocess.run(
+        ['git', '-C', commit.project_path, 'diff-tree', '--no-commit-id', '--name-only', '-r', '--root', '-z', commit.hash],
+        capture_output=True, check=True, text=True
+    ).stdout
+    return [path for path in output.split('\0') if path]
 
 
 def is_source_code(filename):
     """
     Determine if a given filename corresponds to a source code file.
 
-    This function checks the file extension against a predefined list of common
+    This function checks the file extension against a predefined set of common
     source code file extensions. It's a simple way to guess if a file is a source code file.
 
     Args:
@@ -218,17 +693,61 @@ def is_source_code(filename):
     Returns:
     - bool: True if the file extension matches a known source code extension, False otherwise.
     """
-    # A basic list of source code extensions; can be expanded based on requirements
-    source_code_extensions = [
-        '.c', '.cpp', '.h', '.java', '.py', '.js', '.php',
-        '.cs', '.rb', '.go', '.rs', '.ts', '.m', '.swift',
-        '.f', '.f90', '.perl', '.sh', '.bash'
-    ]
-
-    # Extract the extension and check if it's in our list
+    # Extract the extension and check if it's in our set
     _, ext = os.path.splitext(filename)
-    return ext in source_code_extensions
+    return ext in SOURCE_CODE_EXTENSIONS
+
+
+
+def extract_changed_code(modification, context_lines=DIFF_CONTEXT_LINES):
+    """
+    Extract the part of a modified file that is worth analyzing.
+
+    For a new file this is the whole source code. Otherwise, only the lines changed by the commit are kept, together with
+    context_lines lines around them, so that the tokens sent to the AI engine are proportional to the size of the change
+    rather than to the size of the file.
+
+    Args:
+    - modification (ModifiedFile): The pydriller modification of the file.
+    - context_lines (int): The number of unchanged lines to keep before and after each changed line.
+
+    Returns:
+    - str: The excerpt of the source code, with each line prefixed by its line number, or the whole source code of a new file.
+    """
+    source_code = modification.source_code
+    # Split on newlines only, as git does, so that the line numbers match the ones of the diff
+    lines = source_code.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if modification.change_type == ModificationType.ADD or not lines:
+        return source_code
 
+    diff_parsed = modification.diff_parsed
+    added = sorted(line_no for line_no, _ in diff_parsed['added'])
+    changed = list(added)
+    # Deleted lines are numbered in the previous version of the file, shift them by the net number of lines added before
+    # them to find where they were in the new one
+    shift = 0
+    for deleted_count, line_no in enumerate(sorted(line_no for line_no, _ in diff_parsed['deleted'])):
+        while shift < len(added) and added[shift] < line_no - deleted_count + shift:
+            shift += 1
+        changed.append(min(max(1, line_no - deleted_count + shift), len(lines)))
+    if not changed:
+        return source_code
+
+    # Merge the overlapping windows around the changed lines
+    ranges = []
+    for line_no in sorted(set(changed)):
+        start, end = max(1, line_no - context_lines), min(len(lines), line_no + context_lines)
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+
+    return "\n...\n".join(
+        "\n".join(f"{line_no}: {lines[line_no - 1]}" for line_no in range(start, end + 1))
+        for start, end in ranges
+    )
 
 
 def print_bar(length=200, char='█'):
@@ -257,45 +776,252 @@ def url_to_filename(url):
 #Main Function
 
 
+def blob_digest(code):
+    """
+    Hash a code snippet to find identical code across commits and files.
+
+    :param code: Code snippet to hash
+    :return: Hex digest of the code snippet
+    """
+    return hashlib.blake2b(code.encode('utf-8'), digest_size=16).hexdigest()
+
+async def analyze_code_changes(code_changes):
+    """
+    Analyze the code snippets of a commit, analyzing identical code only once.
+
+    Snippets whose code was analyzed recently, in this commit or in an earlier one, reuse that analysis. The other ones
+    are batched and analyzed concurrently.
+
+    Args:
+    - code_changes (list): (path, code) tuples to analyze.
+
+    Returns:
+    - list: (path, debt) tuples, in the same order as code_changes. The debt is None for snippets whose analysis failed.
+    """
+    digests = [blob_digest(code) for _, code in code_changes]
+    commit_debts = {}
+    for digest in digests:
+        if digest in _blob_cache:
+            _blob_cache.move_to_end(digest)
+            commit_debts[digest] = _blob_cache[digest]
+
+    unique_changes = {}
+    for digest, code_change in zip(digests, code_changes):
+        if digest not in commit_debts:
+            unique_changes.setdefault(digest, code_change)
+
+    batches = batch_code_changes(list(unique_changes.values()))
+    for batch in batches:
+        print_bar()
+        print("\nAnalyzing " + ", ".join(path for path, _ in batch) + "\n")
+    results = await asyncio.gather(*[debtDetectBatch(batch) for batch in batches], return_exceptions=True)
+
+    for batch, batch_debts in zip(batches, results):
+        if isinstance(batch_debts, Exception):
+            print(wrap_text("Error: failed to analyze " + ", ".join(path for path, _ in batch) + f": {batch_debts}."))
+            continue
+        for (_, code), debt in zip(batch, batch_debts):
+            commit_debts[blob_digest(code)] = debt
+            _blob_cache[blob_digest(code)] = debt
+    while len(_blob_cache) > BLOB_CACHE_SIZE:
+        _blob_cache.popitem(last=False)
+
+    return [(path, commit_debts.get(digest)) for digest, (path, _) in zip(digests, code_changes)]
+
+def collect_code_changes(commit):
+    """
+    Collect the code of a commit that should be analyzed.
+
+    Args:
+    - commit (Pygit2Commit or pydriller Commit): The commit.
+
+    Returns:
+    - list: (path, code) tuples, several per file when a file is too long for the context of the AI engine.
+    """
+    # pydriller generates the diff of every file of a commit as soon as its modified files are read, and cannot be told
+    # to diff only some of them, so first skip the commits that do not change any file worth analyzing
+    if not isinstance(commit, Pygit2Commit) and not any(
+            is_source_code(path) and not _SKIP_RE.search(path) for path in changed_paths(commit)):
+        return []
+
+    code_changes = []
+    for modification in commit.modified_files:
+        # Check the path first, reading the source code makes the git backend load the file
+        if not modification.new_path or not is_source_code(modification.new_path):
+            continue
+        if _SKIP_RE.search(modification.new_path):
+            continue  # Vendored or generated code
+        if modification.added_lines + modification.deleted_lines < MIN_CHANGED_LINES:
+            continue  # Trivial change
+        if modification.source_code:
+            path = str(modification.new_path)
+            chunks = split_code(path, extract_changed_code(modification))
+            if len(chunks) > 1:
+                print("Splitting " + path + " into " + str(len(chunks)) + " chunks to fit the context of the AI engine")
+            code_changes.extend((path, chunk) for chunk in chunks)
+    return code_changes
+
+def produce_code_changes(repo_url, backend, include_merges, analyzed_commits, queue):
+    """
+    Walk the commits of a repository and put the code to analyze of each commit on a queue.
+
+    This runs in a separate process, so that walking the commits, which keeps git busy, overlaps with waiting for the
+    AI engine. None is put on the queue once all the commits have been walked.
+
+    Args:
+    - repo_url (str): The URL of the repository, or the path to a local clone.
+    - backend (str): The library used to walk the commits.
+    - include_merges (bool): Whether to analyze the files changed by merge commits themselves.
+    - analyzed_commits (set): The hashes of the commits analyzed in a previous run.
+    - queue (multiprocessing.Queue): The queue receiving (commit hash, code changes) tuples.
+    """
+    try:
+        for commit in traverse_commits(repo_url, backend):
+            if commit.hash in analyzed_commits:
+                continue  # Skip if already processed
+            if len(commit.parents) > 1 and not include_merges:
+                continue  # Merge commits rarely change code by themselves
+            code_changes = collect_code_changes(commit)
+            if code_changes:
+                queue.put((commit.hash, code_changes))
+    finally:
+        queue.put(None)
+
+def next_code_changes(queue, producer):
+    """
+    Wait for the next commit put on the queue by the producer process.
+
+    The producer puts None on the queue once all the commits have been walked, but cannot when it is killed, so it is
+    checked to be alive while waiting.
+
+    Args:
+    - queue (multiprocessing.Queue): The queue receiving (commit hash, code changes) tuples.
+    - producer (multiprocessing.Process): The process walking the commits.
+
+    Returns:
+    - tuple: The (commit hash, code changes) of the next commit, or None once the producer is done or died.
+    """
+    while True:
+        # Check before reading, so that whatever the producer put on the queue before dying is read first
+        alive = producer.is_alive()
+        try:
+            return queue.get(timeout=QUEUE_POLL_SECONDS)
+        except Empty:
+            if not alive:
+                return None
+
+async def analyze_commit(commit_hash, code_changes, repo_url, debts_out):
+    """
+    Analyze the code of a commit and append the debts found to the debts file.
+
+    The debts of a commit are only written once all of its code was analyzed, so that a commit found in the debts file
+    is complete. A commit that was not fully analyzed is left out, and analyzed again when resuming; the snippets that
+    were analyzed are then answered from the LLM response cache.
+
+    Args:
+    - commit_hash (str): The hash of the commit.
+    - code_changes (list): (path, code) tuples to analyze.
+    - repo_url (str): The URL of the repository.
+    - debts_out (file): The JSON Lines file receiving the debts.
+    """
+    print_bar()
+    print("\nAnalyzing Commit: " + str(commit_hash) + " in " + repo_url + "\n")
+
+    commit_debts = await analyze_code_changes(code_changes)
+    if any(debt is None for _, debt in commit_debts):
+        print("Commit " + str(commit_hash) + " was not fully analyzed, it will be analyzed again with --resume")
+        return
+
+    records = []
+    for path, debt in commit_debts:
+        # Copy the analysis, it may be shared with other files through the blob cache
+        debt = dict(debt)
+        debt["location"]=path
+        debt["repository"]=repo_url
+        print(debt)
+        records.append(json.dumps({'commit': commit_hash, 'path': path, 'debt': debt}) + '\n')
+    # Save progress after analyzing the modified files in a commit, with a single write so that the commit is not saved in part
+    print("Saving to Debts JSONL...")
+    debts_out.write(''.join(records))
+    debts_out.flush()
+
+def load_analyzed_commits(debts_file):
+    """
+    Read the hashes of the commits analyzed in a previous run from its debts file, without keeping their debts in memory.
+
+    The last record is torn if the previous run was killed while saving a commit. It is skipped and cut from the file,
+    so that the records appended when resuming start on a line of their own.
+
+    Args:
+    - debts_file (str): The path of the JSON Lines debts file.
+
+    Returns:
+    - set: The hashes of the analyzed commits.
+    """
+    analyzed_commits = set()
+    with open(debts_file, 'r+b') as file:
+        end, valid_end = 0, 0
+        for line in file:
+            end += len(line)
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError("Missing end of line")
+                analyzed_commits.add(json.loads(line)['commit'])
+                valid_end = end
+            except (ValueError, KeyError, TypeError):
+                print("Skipping a corrupt record in " + debts_file)
+        if valid_end < end:
+            file.truncate(valid_end)
+    return analyzed_commits
+
 # Main Function
-def main(repo_url, resume=False):
-    debts_file = url_to_filename(repo_url)+'_debts.json'
-    debts = {}
+async def main(repo_url, resume=False, backend='pygit2', include_merges=False):
+    debts_file = url_to_filename(repo_url)+'_debts.jsonl'
+    analyzed_commits = set()
 
-    # Load existing debts if resume is True
+    # Load the hashes of the commits analyzed in a previous run if resume is True
     if resume and os.path.exists(debts_file):
-        with open(debts_file, 'r') as file:
-            debts = json.load(file)
+        analyzed_commits = load_analyzed_commits(debts_file)
 
-    for commit in Repository(repo_url).traverse_commits():
-        if commit.hash in debts and debts[commit.hash]:
-            continue  # Skip if already processed
+    # Commits are walked by a producer process while this event loop analyzes the commits already walked
+    queue = multiprocessing.Queue(maxsize=COMMIT_QUEUE_SIZE)
+    producer = multiprocessing.Process(target=produce_code_changes, args=(repo_url, backend, include_merges, analyzed_commits, queue), daemon=True)
+    producer.start()
+    loop = asyncio.get_running_loop()
 
-        print_bar()
-        print("\nAnalyzing Commit: " + str(commit.hash) + " in " + repo_url + "\n")
-
-        for modification in commit.modified_files:
-            modified_files_content = modification.source_code
-            if modified_files_content and is_source_code(modification.new_path):
-                print_bar()
-                print("\nAnalyzing " + str(modification.new_path) + "\n")
-                guard = createGuard(modified_files_content)
-                debt = debtDetect(modified_files_content, guard)
-                debt["location"]=str(modification.new_path) 
-                debt["repository"]=repo_url
-                print(debt)
-                debts[commit.hash] = debt
-                # Save progress after analyzing each modified file in a commit
-                with open(debts_file, 'w') as file:
-                    print("Saving to Debts JSON...")
-                    json.dump(debts, file, indent=4)
+    # Debts are appended to a JSON Lines file, one record per analyzed file, so saving progress does not rewrite earlier results
+    with open(debts_file, 'a' if resume else 'w') as debts_out:
+        pending = set()
+        while True:
+            item = await loop.run_in_executor(None, next_code_changes, queue, producer)
+            if item is None:
+                break
+            commit_hash, code_changes = item
+            pending.add(asyncio.create_task(analyze_commit(commit_hash, code_changes, repo_url, debts_out)))
+            if len(pending) >= MAX_PENDING_COMMITS:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            for task in done:
+                task.result()
+
+    producer.join()
+    if producer.exitcode != 0:
+        raise RuntimeError("Failed to walk the commits of " + repo_url)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyze a GitHub repository for technical debts.")
     parser.add_argument("repo_url", help="URL of the GitHub repository to analyze")
     parser.add_argument("--resume", action="store_true", help="Resume from the last saved state")
+    parser.add_argument("--backend", choices=["pygit2", "pydriller"], default="pygit2", help="Library used to walk the commits of the repository")
+    parser.add_argument("--include-merges", action="store_true", help="Also analyze the files changed by merge commits themselves, such as conflict resolutions (pygit2 backend only)")
     args = parser.parse_args()
+    if args.include_merges and args.backend == "pydriller":
+        # pydriller does not list the modified files of merge commits
+        parser.error("--include-merges is only supported with the pygit2 backend")
 
-    main(args.repo_url, args.resume)
+    asyncio.run(main(args.repo_url, args.resume, args.backend, args.include_merges))
 
 